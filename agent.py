@@ -9,16 +9,45 @@ import os
 import subprocess
 import sys
 import re
+import reprlib
+import shutil
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from typing import Optional
 
+try:
+    import orjson  # Optional: much faster JSON parsing for the token stream
+except ImportError:
+    orjson = None
+
 # Configuration
 OLLAMA_URL = "http://192.168.0.200:11434"
 MODEL = "qwen2.5-coder:7b"  # Change this to your preferred model
 MAX_CONTEXT_TOKENS = 8192
+KEEP_ALIVE = "30m"  # How long Ollama keeps the model loaded between requests
+MAX_HISTORY_MESSAGES = 64  # Older turns are dropped; the system prompt is always kept
 AUTO_APPROVE_READS = True  # Auto-approve file reads without confirmation
 
+# Shared HTTP session so every agent iteration reuses the same keep-alive connection
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+_SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can catch the stdlib one
+_json_loads = orjson.loads if orjson else json.loads
+
+def _json_dumps(obj) -> bytes:
+    if orjson:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # e.g. lone surrogates from undecodable filenames, which json escapes as \udcXX
+            pass
+    return json.dumps(obj).encode("utf-8")
+
 # ANSI colors for terminal output
 class Colors:
     BLUE = "\033[94m"
@@ -36,7 +65,9 @@ def print_colored(text: str, color: str = Colors.END):
 def print_tool_call(tool_name: str, args: dict):
     print_colored(f"\n🔧 Tool: {tool_name}", Colors.CYAN + Colors.BOLD)
     for key, value in args.items():
-        display_value = value if len(str(value)) < 100 else str(value)[:100] + "..."
+        # reprlib bounds nested lists/dicts so large args are never fully stringified
+        text = value if isinstance(value, str) else reprlib.repr(value)
+        display_value = text if len(text) < 100 else text[:100] + "..."
         print_colored(f"   {key}: {display_value}", Colors.CYAN)
 
 def print_tool_result(result: str, max_lines: int = 20):
@@ -139,7 +170,7 @@ TOOLS = [
             "properties": {
                 "pattern": {
                     "type": "string",
-                    "description": "The search pattern (supports regex)"
+                    "description": "The search pattern (extended regex, e.g. 'foo|bar')"
                 },
                 "path": {
                     "type": "string",
@@ -170,6 +201,16 @@ TOOLS = [
 ]
 
 # Tool implementations
+WRITE_CHUNK_CHARS = 1 << 20
+# Tools without side effects; consecutive calls to these may run in parallel
+READ_ONLY_TOOLS = {"read_file", "list_directory", "search_files"}
+
+@lru_cache(maxsize=64)
+def _cached_read(path: str, mtime_ns: int, size: int) -> str:
+    """Read a file, memoized on (path, mtime, size) so edit retries skip the disk"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
 def read_file(path: str) -> str:
     try:
         path = os.path.expanduser(path)
@@ -183,12 +224,36 @@ def read_file(path: str) -> str:
     except Exception as e:
         return f"Error reading file: {str(e)}"
 
+def _file_has_content(path: str, content: str) -> bool:
+    """Check whether the file at path already holds exactly this content"""
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return False
+    # UTF-8 uses 1-4 bytes per character, so most changed files are ruled out by size alone
+    if not len(content) <= size <= 4 * len(content):
+        return False
+    try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for offset in range(0, len(content), WRITE_CHUNK_CHARS):
+                chunk = content[offset:offset + WRITE_CHUNK_CHARS]
+                if f.read(len(chunk)) != chunk:
+                    return False
+            return f.read(1) == ""
+    except (OSError, UnicodeDecodeError):
+        return False
+
 def write_file(path: str, content: str) -> str:
     try:
         path = os.path.expanduser(path)
+        if _file_has_content(path, content):
+            return f"File unchanged: {path} already contains exactly this content"
         os.makedirs(os.path.dirname(path) if os.path.dirname(path) else '.', exist_ok=True)
         with open(path, 'w', encoding='utf-8') as f:
-            f.write(content)
+            # Write in slices so only one chunk is ever held in encoded form
+            for offset in range(0, len(content), WRITE_CHUNK_CHARS):
+                f.write(content[offset:offset + WRITE_CHUNK_CHARS])
+        _cached_read.cache_clear()
         return f"Successfully wrote {len(content)} characters to {path}"
     except PermissionError:
         return f"Error: Permission denied: {path}"
@@ -201,21 +266,25 @@ def edit_file(path: str, old_content: str, new_content: str) -> str:
         if not os.path.exists(path):
             return f"Error: File not found: {path}"
         
-        with open(path, 'r', encoding='utf-8') as f:
-            file_content = f.read()
+        stat = os.stat(path)
+        file_content = _cached_read(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
         
-        if old_content not in file_content:
+        start = file_content.find(old_content)
+        if start < 0:
             return "Error: Could not find the exact 'old_content' in the file. Please make sure the search block matches exactly (including indentation and spaces)."
         
         # Prüfen, ob der Block mehrfach vorkommt
-        occurrences = file_content.count(old_content)
-        if occurrences > 1:
+        end = start + len(old_content)
+        # An empty block matches at every position, so look for the next one a character later
+        if file_content.find(old_content, end if old_content else end + 1) >= 0:
+            occurrences = file_content.count(old_content)
             return f"Error: The 'old_content' block was found {occurrences} times. Please provide a more specific unique block to replace."
         
-        new_file_content = file_content.replace(old_content, new_content)
+        new_file_content = file_content[:start] + new_content + file_content[end:]
         
         with open(path, 'w', encoding='utf-8') as f:
             f.write(new_file_content)
+        _cached_read.cache_clear()
             
         return f"Successfully edited {path}. Replaced unique occurrence of the specified block."
     except Exception as e:
@@ -225,15 +294,16 @@ def list_directory(path: str = ".") -> str:
     try:
         path = os.path.expanduser(path) if path else "."
         entries = []
-        for entry in sorted(os.listdir(path)):
-            if entry.startswith('.'):
-                continue  # Skip hidden files
-            full_path = os.path.join(path, entry)
-            if os.path.isdir(full_path):
-                entries.append(f"📁 {entry}/")
-            else:
-                size = os.path.getsize(full_path)
-                entries.append(f"📄 {entry} ({size} bytes)")
+        # scandir gets the entry type from readdir itself, saving a stat() per entry
+        with os.scandir(path) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if entry.name.startswith('.'):
+                    continue  # Skip hidden files
+                if entry.is_dir():
+                    entries.append(f"📁 {entry.name}/")
+                else:
+                    size = entry.stat().st_size
+                    entries.append(f"📄 {entry.name} ({size} bytes)")
         return '\n'.join(entries) if entries else "(empty directory)"
     except FileNotFoundError:
         return f"Error: Directory not found: {path}"
@@ -263,15 +333,30 @@ def run_command(command: str) -> str:
     except Exception as e:
         return f"Error running command: {str(e)}"
 
+# Prefer ripgrep for search_files when it is installed (parallel walk, no backtracking)
+RG_PATH = shutil.which("rg")
+
 def search_files(pattern: str, path: str = ".", file_pattern: str = None) -> str:
     try:
         path = os.path.expanduser(path) if path else "."
-        cmd = f"grep -rn --color=never"
-        if file_pattern:
-            cmd += f" --include='{file_pattern}'"
-        cmd += f" '{pattern}' {path} 2>/dev/null | head -50"
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=30)
-        output = result.stdout.strip()
+        if RG_PATH:
+            # Search hidden and ignored files too, so results match grep -r
+            argv = [RG_PATH, "--no-heading", "-n", "--color=never", "--hidden", "--no-ignore"]
+            if file_pattern:
+                argv += ["-g", file_pattern]
+        else:
+            # Extended regex, so |, +, ? etc. mean the same as with rg
+            argv = ["grep", "-rnE", "--color=never"]
+            if file_pattern:
+                argv += [f"--include={file_pattern}"]
+        # argv list instead of shell=True: no /bin/sh fork and no quoting issues
+        argv += ["-e", pattern, "--", path]
+        result = subprocess.run(argv, capture_output=True, text=True, timeout=30)
+        output = '\n'.join(result.stdout.splitlines()[:50]).strip()
+        # Exit status 2 without any matches means the search itself failed (e.g. invalid regex)
+        if not output and result.returncode == 2:
+            message = '\n'.join(result.stderr.strip().splitlines()[:5])
+            return f"Error searching: {message or 'search failed'}"
         return output if output else f"No matches found for pattern: {pattern}"
     except subprocess.TimeoutExpired:
         return "Error: Search timed out"
@@ -307,7 +392,7 @@ def execute_tool(tool_name: str, args: dict) -> tuple[str, bool]:
 
 def get_confirmation(tool_name: str, args: dict) -> bool:
     """Ask user for confirmation before executing a tool"""
-    if AUTO_APPROVE_READS and tool_name in ["read_file", "list_directory", "search_files"]:
+    if AUTO_APPROVE_READS and tool_name in READ_ONLY_TOOLS:
         return True
     
     print_colored("\n⚠️  Approve this action? [y/n/q]: ", Colors.YELLOW)
@@ -318,7 +403,10 @@ def get_confirmation(tool_name: str, args: dict) -> bool:
     return response in ['y', 'yes', '']
 
 def build_system_prompt() -> str:
-    cwd = os.getcwd()
+    return _system_prompt_for(os.getcwd())
+
+@lru_cache(maxsize=8)
+def _system_prompt_for(cwd: str) -> str:
     return f"""You are a helpful coding assistant with access to tools for reading/writing files and running commands.
 
 Current working directory: {cwd}
@@ -339,7 +427,7 @@ IMPORTANT INSTRUCTIONS:
 ```
 
 2. You can include explanation text before or after the tool block.
-3. Only call ONE tool at a time, then wait for the result.
+3. Only call ONE tool at a time, then wait for the result. Exception: several read-only calls (read_file, list_directory, search_files) may be sent together as separate tool blocks.
 4. After receiving tool results, continue working or call task_complete when done.
 5. Always read relevant files before modifying them.
 6. For coding tasks, make sure to test your changes if possible.
@@ -370,61 +458,167 @@ Example tool calls:
 }}
 """
 
-def parse_tool_call(response: str) -> Optional[tuple[str, dict]]:
-    """Extract tool call from model response"""
-    # Look for ```tool blocks
-    pattern = r'```tool\s*\n?\s*(\{.*?\})\s*\n?```'
-    matches = re.findall(pattern, response, re.DOTALL)
-    
-    if matches:
-        try:
-            data = json.loads(matches[0])
-            return data.get("tool"), data.get("args", {})
-        except json.JSONDecodeError:
-            pass
+# Characters that matter when matching braces in JSON; everything else is skipped in C
+_JSON_SPECIAL_RE = re.compile(r'[{}"\\`]')
+
+def _match_braces(s: str, start: int, stop: int = None) -> int:
+    """Return the index just past the balanced {...} opening at s[start], or -1"""
+    depth = 0
+    in_string = False
+    escaped_at = -1
+    for m in _JSON_SPECIAL_RE.finditer(s, start, len(s) if stop is None else stop):
+        i = m.start()
+        if i == escaped_at:
+            continue
+        c = s[i]
+        if in_string:
+            if c == '\\':
+                escaped_at = i + 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        elif c == '`':
+            return -1  # A closing fence outside any string: the object never balanced
+    return -1
+
+def _find_tool_block(s: str, pos: int = 0, fenced: bool = True) -> Optional[tuple[str, int, int]]:
+    """Return (json_text, block_start, block_end) for the first tool call at or after pos, or None"""
+    if fenced:
+        fence = s.find("```tool", pos)
+        while fence >= 0:
+            # A truncated block must not swallow the ones after it, so never scan past the next fence
+            next_fence = s.find("```tool", fence + len("```tool"))
+            stop = next_fence if next_fence >= 0 else len(s)
+            start = s.find("{", fence + len("```tool"), stop)
+            end = _match_braces(s, start, stop) if start >= 0 else -1
+            if end >= 0:
+                # The block span also covers the ```tool fence
+                block_end = end
+                close = s.find("```", end)
+                if close >= 0 and not s[end:close].strip():
+                    block_end = close + len("```")
+                return s[start:end], fence, block_end
+            fence = next_fence
+        return None
     
-    # Fallback: look for raw JSON with tool key
-    pattern = r'\{\s*"tool"\s*:\s*"(\w+)"\s*,\s*"args"\s*:\s*(\{[^}]*\})\s*\}'
-    match = re.search(pattern, response, re.DOTALL)
-    if match:
+    # Bare {"tool": ...} objects; an unbalanced one is skipped in favour of the next "tool" key
+    key = s.find('"tool"', pos)
+    while key >= 0:
+        brace = s.rfind("{", pos, key)
+        if brace >= 0 and not s[brace + 1:key].strip():
+            end = _match_braces(s, brace)
+            if end >= 0:
+                return s[brace:end], brace, end
+        key = s.find('"tool"', key + 1)
+    return None
+
+def _collect_tool_calls(response: str, fenced: bool) -> tuple[list[tuple[str, dict]], str]:
+    calls = []
+    kept = []  # Text between tool blocks, joined into the explanation
+    pos = 0
+    while True:
+        block = _find_tool_block(response, pos, fenced)
+        if not block:
+            break
+        raw, start, end = block
         try:
-            args = json.loads(match.group(2))
-            return match.group(1), args
+            data = _json_loads(raw)
         except json.JSONDecodeError:
-            pass
+            data = None
+        if not isinstance(data, dict):
+            data = {}
+        tool, args = data.get("tool"), data.get("args", {})
+        # Tool names must be strings (READ_ONLY_TOOLS is a set) and args a dict
+        if tool and isinstance(tool, str) and isinstance(args, dict):
+            calls.append((tool, args))
+            kept.append(response[pos:start])
+        else:
+            kept.append(response[pos:end])
+        pos = end
     
-    return None, None
+    if not calls:
+        return [], response
+    kept.append(response[pos:])
+    return calls, "".join(kept).strip()
+
+def parse_tool_calls(response: str) -> tuple[list[tuple[str, dict]], str]:
+    """Extract all tool calls from model response as ([(tool_name, args), ...], explanation)"""
+    # Bare {"tool": ...} objects only count when no ```tool block holds a valid call;
+    # otherwise a JSON example in the surrounding prose would turn into an extra call
+    calls, explanation = _collect_tool_calls(response, fenced=True)
+    if calls:
+        return calls, explanation
+    return _collect_tool_calls(response, fenced=False)
 
 def chat_with_ollama(messages: list) -> str:
     """Sendet Nachrichten an Ollama mit Streaming-Support"""
     try:
-        response = requests.post(
+        body = _json_dumps({
+            "model": MODEL,
+            "messages": messages,
+            "stream": True,  # Streaming aktivieren
+            "keep_alive": KEEP_ALIVE,
+            "options": {"num_ctx": MAX_CONTEXT_TOKENS}
+        })
+        with _SESSION.post(
             f"{OLLAMA_URL}/api/chat",
-            json={
-                "model": MODEL,
-                "messages": messages,
-                "stream": True,  # Streaming aktivieren
-                "options": {"num_ctx": MAX_CONTEXT_TOKENS}
-            },
+            data=body,
+            headers={"Content-Type": "application/json"},
             timeout=120,
             stream=True
-        )
-        response.raise_for_status()
-        
-        full_content = ""
-        for line in response.iter_lines():
-            if line:
-                chunk = json.loads(line)
-                if "message" in chunk and "content" in chunk["message"]:
-                    content = chunk["message"]["content"]
-                    full_content += content
-                    # Wir drucken den Content direkt aus (ohne Zeilenumbruch)
-                    print(content, end="", flush=True)
-        return full_content
+        ) as response:
+            response.raise_for_status()
+            
+            parts = []
+            pending = []
+            for line in response.iter_lines(decode_unicode=False):
+                if line:
+                    chunk = _json_loads(line)
+                    if "message" in chunk and "content" in chunk["message"]:
+                        content = chunk["message"]["content"]
+                        parts.append(content)
+                        # Batch tokens and flush on newline or every 16 chunks instead of per token
+                        pending.append(content)
+                        if "\n" in content or len(pending) >= 16:
+                            sys.stdout.write("".join(pending))
+                            sys.stdout.flush()
+                            pending.clear()
+            if pending:
+                sys.stdout.write("".join(pending))
+                sys.stdout.flush()
+        return "".join(parts)
     except Exception as e:
         print_colored(f"\n❌ Error: {e}", Colors.RED)
         sys.exit(1)
 
+# User-role messages that agent_loop writes itself, as opposed to real user requests
+_TOOL_FEEDBACK_PREFIXES = ("Tool result", "Tool execution was skipped")
+
+def _starts_turn(message: dict) -> bool:
+    return message["role"] == "user" and not message["content"].startswith(_TOOL_FEEDBACK_PREFIXES)
+
+def trim_history(messages: list) -> None:
+    """Drop the oldest whole turns so at most MAX_HISTORY_MESSAGES follow the system prompt"""
+    excess = len(messages) - 1 - MAX_HISTORY_MESSAGES
+    if excess <= 0:
+        return
+    
+    # Cut at the next user request so no reply or tool result loses the turn it belongs to;
+    # if the current turn alone is over the cap, keep it whole
+    turn_starts = [i for i in range(1, len(messages)) if _starts_turn(messages[i])]
+    later = [i for i in turn_starts if i > excess]
+    if later:
+        del messages[1:later[0]]
+    elif turn_starts:
+        del messages[1:turn_starts[-1]]
+
 def agent_loop(user_input: str, messages: list) -> list:
     """Main agent loop - processes user input and executes tools"""
     messages.append({"role": "user", "content": user_input})
@@ -437,24 +631,55 @@ def agent_loop(user_input: str, messages: list) -> list:
         print_colored(f"\n{'─' * 50}", Colors.BLUE)
         print_colored(f"🤖 Thinking... (iteration {iteration})", Colors.MAGENTA)
         
+        trim_history(messages)
         response = chat_with_ollama(messages)
         
         # Parse for tool calls
-        tool_name, tool_args = parse_tool_call(response)
+        tool_calls, explanation = parse_tool_calls(response)
         
-        if tool_name:
+        if tool_calls:
             # Print the model's explanation (text before/after tool call)
-            explanation = re.sub(r'```tool\s*\n?\s*\{.*?\}\s*\n?```', '', response, flags=re.DOTALL).strip()
             if explanation:
                 print_colored(f"\n💭 {explanation}", Colors.END)
             
+            # A batch of read-only calls runs concurrently once approved (file reads release the GIL)
+            if len(tool_calls) > 1 and all(name in READ_ONLY_TOOLS for name, _ in tool_calls):
+                approved = []
+                for name, args in tool_calls:
+                    print_tool_call(name, args)
+                    approved.append(get_confirmation(name, args))
+                to_run = [call for call, ok in zip(tool_calls, approved) if ok]
+                with ThreadPoolExecutor(max_workers=8) as pool:
+                    results = iter(list(pool.map(lambda call: execute_tool(*call)[0], to_run)))
+                
+                sections = []
+                for (name, args), ok in zip(tool_calls, approved):
+                    if ok:
+                        result = next(results)
+                        print_tool_result(result)
+                    else:
+                        result = "Tool execution was skipped by user."
+                        print_colored(f"⏭️  Skipped {name}", Colors.YELLOW)
+                    sections.append(f"Tool result ({name} {json.dumps(args)}):\n{result}")
+                
+                messages.append({"role": "assistant", "content": response})
+                messages.append({"role": "user", "content": "\n\n".join(sections) + "\n\nContinue with the task or call task_complete if done."})
+                continue
+            
+            # Otherwise only the first call is executed; tell the model about the rest
+            tool_name, tool_args = tool_calls[0]
             print_tool_call(tool_name, tool_args)
+            not_run = ""
+            if len(tool_calls) > 1:
+                ignored = ", ".join(name for name, _ in tool_calls[1:])
+                print_colored(f"⏭️  Not run (one tool at a time): {ignored}", Colors.YELLOW)
+                not_run = f"\n\nOnly the first tool call was executed. These calls were NOT run: {ignored}. Call them again one at a time if still needed."
             
             # Get confirmation
             if not get_confirmation(tool_name, tool_args):
                 print_colored("⏭️  Skipped", Colors.YELLOW)
                 messages.append({"role": "assistant", "content": response})
-                messages.append({"role": "user", "content": "Tool execution was skipped by user. Please continue or try a different approach."})
+                messages.append({"role": "user", "content": f"Tool execution was skipped by user.{not_run} Please continue or try a different approach."})
                 continue
             
             # Execute tool
@@ -468,7 +693,7 @@ def agent_loop(user_input: str, messages: list) -> list:
             
             # Add to conversation
             messages.append({"role": "assistant", "content": response})
-            messages.append({"role": "user", "content": f"Tool result:\n{result}\n\nContinue with the task or call task_complete if done."})
+            messages.append({"role": "user", "content": f"Tool result ({tool_name}):\n{result}{not_run}\n\nContinue with the task or call task_complete if done."})
         else:
             # No tool call - just print response
             print_colored(f"\n💬 {response}", Colors.END)
@@ -481,6 +706,7 @@ def agent_loop(user_input: str, messages: list) -> list:
     return messages
 
 def main():
+    global MODEL
     print_colored("""
 ╔═══════════════════════════════════════════════════════════════╗
 ║           🤖 Local Code Agent (Ollama Edition)                ║
@@ -521,7 +747,6 @@ def main():
                 elif cmd == '/model':
                     parts = user_input.split(maxsplit=1)
                     if len(parts) > 1:
-                        global MODEL
                         MODEL = parts[1]
                         print_colored(f"🧠 Model changed to: {MODEL}", Colors.GREEN)
                     else:
@@ -532,8 +757,13 @@ def main():
                     parts = user_input.split(maxsplit=1)
                     if len(parts) > 1:
                         try:
+                            old_cwd = os.getcwd()
                             os.chdir(os.path.expanduser(parts[1]))
-                            messages = [{"role": "system", "content": build_system_prompt()}]
+                            # Only the cwd in the system prompt changes; keep the conversation,
+                            # but tell the model that earlier relative paths meant the old directory
+                            messages[0] = {"role": "system", "content": build_system_prompt()}
+                            if len(messages) > 1:
+                                messages.append({"role": "user", "content": f"Working directory changed to {os.getcwd()}; earlier relative paths referred to {old_cwd}."})
                             print_colored(f"📂 Changed to: {os.getcwd()}", Colors.GREEN)
                         except Exception as e:
                             print_colored(f"Error: {e}", Colors.RED)